@@ -413,9 +413,10 @@ Slot table size: {}</center>
                 paths = []
                 ni = 0 if l < 6 else 1
                 link = l if ni == 0 else l - 6
+                pids = self.ctrl_mod.tdm_info.table_pid[n, ni, link].tolist()
                 for s in range(self.slot_table_size):
-                    pid = self.ctrl_mod.tdm_info.table_config[n][ni][link][s][1]
-                    if pid is not None:
+                    pid = pids[s]
+                    if pid >= 0:
                         reserved.append([s, pid])
                         if pid not in paths:
                             paths.append(pid)
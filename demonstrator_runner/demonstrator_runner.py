@@ -73,7 +73,7 @@ def main(args):
     # Create control module client
     ctrl = CtrlModClient(log, LOCALHOST, ncm[0]['addr'])
     # Create system manager
-    sys_manager = SystemManager(log, args, ctrl.x_dim, ctrl.y_dim, args.verify)
+    sys_manager = get_system_manager(log, args, ctrl.x_dim, ctrl.y_dim, args.verify)
     # Create NoC gateway
     gw = NoCGateway(log, LOCALHOST, noc_bridge[0]['addr'], ctrl.x_dim, ctrl.y_dim)
     # Create surveillance hostmod
@@ -31,6 +31,7 @@ Author(s):
 
 import osd
 from demonstratorlib.constants import *
+from demonstratorlib.module_util import reg_read_many, event_header
 from demonstratorlib.tdm_util import *
 from demonstratorlib.path_util import *
 
@@ -48,6 +49,10 @@ FAULT_CONFIG = 0
 TDM_CONFIG = 1
 CLK_CONFIG = 2
 
+# Max. number of slot table entries in a single TDM_CONFIG event. DI packets
+# are limited to 12 words: 3 header words, the sub-module, and 4 flit pairs.
+MAX_TDM_CONFIG_ENTRIES = 4
+
 MOD = None
 
 
@@ -57,24 +62,31 @@ class CtrlModClient(osd.Hostmod):
         MOD = self.__class__.__name__
         self.hm = osd.Hostmod(log, host_controller_address, event_handler=self.receive_handler)
         self.module_diaddr = diaddr_ctrl_mod
-        self._util_handler = None
-        self._fd_handler = None
+        # Registered handler for each sub-id of packets from the NCM
+        self._handlers = {SUB_ID_FD: None, SUB_ID_UTIL: None}
 
         # set_num_tdm_ep() must be called before starting to configure the NoC
         self.num_tdm_ep = None
         self.tdm_info = None
 
         self.hm.connect()
+        self._evt_header = event_header(self.hm.diaddr, self.module_diaddr)
         self._initialize_variables()
         self.hm.mod_set_event_dest(self.module_diaddr)
 
     def _initialize_variables(self):
-        self.slot_table_size = self.hm.reg_read(self.module_diaddr, REG_RD_SLOT_TABLE_SIZE)
-        dimensions = self.hm.reg_read(self.module_diaddr, REG_RD_DIMENSIONS)
+        (self.slot_table_size,
+         dimensions,
+         self.max_num_tdm_ep,
+         self.simple_ncm) = reg_read_many(self.hm, self.module_diaddr,
+                                          (REG_RD_SLOT_TABLE_SIZE,
+                                           REG_RD_DIMENSIONS,
+                                           REG_RD_MAX_PORTS,
+                                           REG_RD_SIMPLE_NCM))
         self.x_dim = dimensions & 0xff
         self.y_dim = (dimensions >> 8) & 0xff
-        self.max_num_tdm_ep = self.hm.reg_read(self.module_diaddr, REG_RD_MAX_PORTS)
-        self.simple_ncm = self.hm.reg_read(self.module_diaddr, REG_RD_SIMPLE_NCM)
+        # (x, y) coordinates of every node
+        self._node_xy = [(n % self.x_dim, n // self.x_dim) for n in range(self.x_dim * self.y_dim)]
         self.fault_vector = [0] * (self.x_dim * self.y_dim)
         # Dictionary keeping track of all configured TDM channels. pid is key
         self.nxt_pid = 0
@@ -82,6 +94,8 @@ class CtrlModClient(osd.Hostmod):
         # Dictionary keeping track of all configured TDM paths. chid is key
         self.nxt_chid = 0
         self.tdm_paths = {}
+        # Cached dictionaries for the monitoring GUI
+        self._invalidate_dicts()
 
     def _reset_variables(self):
         self.fault_vector = [0] * (self.x_dim * self.y_dim)
@@ -89,13 +103,13 @@ class CtrlModClient(osd.Hostmod):
         self.tdm_channels = {}
         self.nxt_chid = 0
         self.tdm_paths = {}
+        self._invalidate_dicts()
         if self.tdm_info is not None:
             self.tdm_info.reset()
 
     def _reset_faults(self):
         for node in range(self.x_dim * self.y_dim):
-            event_pkt = self._create_event_pkt(FAULT_CONFIG)
-            event_pkt.payload.append((node << 8))
+            event_pkt = self._create_event_pkt((FAULT_CONFIG, node << 8))
             self.hm.event_send(event_pkt)
 
     def set_num_tdm_ep(self, num_tdm_ep):
@@ -126,48 +140,51 @@ class CtrlModClient(osd.Hostmod):
             else:
                 print(e)
 
-    def register_util_handler(self, handler):
-        if self._util_handler is not None:
+    def _register_handler(self, sub_id, handler):
+        if self._handlers[sub_id] is not None:
             return False
-        self._util_handler = handler
+        self._handlers[sub_id] = handler
         return True
 
-    def unregister_util_handler(self, handler):
-        if self._util_handler != handler:
+    def _unregister_handler(self, sub_id, handler):
+        if self._handlers[sub_id] != handler:
             return False
-        self._util_handler = None
+        self._handlers[sub_id] = None
         return True
 
+    def register_util_handler(self, handler):
+        return self._register_handler(SUB_ID_UTIL, handler)
+
+    def unregister_util_handler(self, handler):
+        return self._unregister_handler(SUB_ID_UTIL, handler)
+
     def register_fd_handler(self, handler):
-        if self._fd_handler is not None:
-            return False
-        self._fd_handler = handler
-        return True
+        return self._register_handler(SUB_ID_FD, handler)
 
     def unregister_fd_handler(self, handler):
-        if self._fd_handler != handler:
-            return False
-        self._fd_handler = None
-        return True
+        return self._unregister_handler(SUB_ID_FD, handler)
 
-    def _create_event_pkt(self, sub_mod):
+    def _create_event_pkt(self, payload):
         """
         Create an event packet and initialize the header sections.
+        'payload' is the complete payload as a tuple of 16-bit words, starting
+        with the sub-module. It is written to the packet at once.
         """
         event_pkt = osd.Packet()
-        event_pkt.set_header(src=self.hm.diaddr, dest=self.module_diaddr, type=2, type_sub=0)
-        event_pkt.payload.append(sub_mod)
+        event_pkt.set_header(**self._evt_header)
+        event_pkt.payload.extend(payload)
         return event_pkt
 
     def _configure_util_clk_cnt(self, max_clk_cnt):
-        event_pkt = self._create_event_pkt(CLK_CONFIG)
-        event_pkt.payload.append(max_clk_cnt & 0xffff)
-        event_pkt.payload.append((max_clk_cnt >> 16) & 0xffff)
+        event_pkt = self._create_event_pkt((CLK_CONFIG,
+                                            max_clk_cnt & 0xffff,
+                                            (max_clk_cnt >> 16) & 0xffff))
         self.hm.event_send(event_pkt)
 
-    def _configure_slot_table(self, node, port, slot, config, pid=None, ni=False):
+    def _slot_table_flits(self, node, port, slot, config, ni=False):
         """
-        Configure a single entry of a slot table.
+        Create the two payload flits to configure a single entry of a slot
+        table.
         Bits 0-14 of the first payload flit determine the node, the MSB
         determines whether a NI shall be configured (1) or a router (0).
         The low byte of the second payload flit determines the slot table (port)
@@ -180,54 +197,102 @@ class CtrlModClient(osd.Hostmod):
          - router ports and endpoints: 16
          - slot table size: 256
         """
-        event_pkt = self._create_event_pkt(TDM_CONFIG)
-        event_pkt.payload.append(((slot & 0xff) << 8) | ((config & 0xf) << 4) | (port & 0xf))
         msb = (1 << 15) if ni else 0
-        event_pkt.payload.append(msb | (node & 0x7fff))
-        self.hm.event_send(event_pkt)
+        return (((slot & 0xff) << 8) | ((config & 0xf) << 4) | (port & 0xf),
+                msb | (node & 0x7fff))
+
+    def _ep_link_flits(self, node, ep, link, enable=True):
+        """
+        Create the two payload flits to enable or disable a link for the out
+        queue of a TDM endpoint. Bit 14 of the second flit marks the flits as
+        link configuration.
+        """
+        return (((link & 0xff) << 8) | ((1 if enable else 0) << 4) | (ep & 0xf),
+                (1 << 14) | (node & 0x7fff))
+
+    def _path_payloads(self, entries, node, ep, link, enable):
+        """
+        Create the payloads of the TDM_CONFIG events that write the slot table
+        entries of a TDM path and enable or disable the link of the source
+        endpoint.
+        The NCM processes any number of flit pairs in a TDM_CONFIG packet, so
+        up to MAX_TDM_CONFIG_ENTRIES flit pairs are packed into each event.
+        The link is enabled with the last or disabled with the first flit pair
+        so that it is never active for a partially configured path.
+        """
+        flits = []
+        for e_node, ni, port, slot, config in entries:
+            flits.extend(self._slot_table_flits(e_node, port, slot, config, ni))
+        link_flits = list(self._ep_link_flits(node, ep, link, enable))
+        flits = flits + link_flits if enable else link_flits + flits
+        step = 2 * MAX_TDM_CONFIG_ENTRIES
+        return [(TDM_CONFIG,) + tuple(flits[i:i+step]) for i in range(0, len(flits), step)]
+
+    def _set_table_entries(self, entries, pid):
+        """
+        Mirror written slot table entries in the TDM info object.
+        """
         if self.tdm_info is not None:
-            self.tdm_info.set_table_entry(node, ni, port, slot, config, pid)
+            for node, ni, port, slot, config in entries:
+                self.tdm_info.set_table_entry(node, ni, port, slot, config, pid)
 
-    def _configure_ep_link(self, node, ep, link, enable=True):
+    def _send_events(self, payloads):
         """
-        Enable or disable a link for the out queue of a TDM endpoint.
+        Send one event to the NCM for each given payload.
         """
-        event_pkt = self._create_event_pkt(TDM_CONFIG)
-        event_pkt.payload.append(((link & 0xff) << 8) | ((1 if enable else 0) << 4) | (ep & 0xf))
-        event_pkt.payload.append((1 << 14) | (node & 0x7fff))
-        self.hm.event_send(event_pkt)
+        for payload in payloads:
+            self.hm.event_send(self._create_event_pkt(payload))
+
+    def _invalidate_dicts(self):
+        """
+        Must be called whenever TDM paths or channels change.
+        """
+        self._paths_dict = None
+        self._channels_dict = None
 
     def create_path_dict(self):
         """
         Creates a dictionary with all TDM paths in the NoC. The dictionary can
         be sent to the monitoring GUI.
+        The dictionary is cached until the TDM paths change.
         """
+        if self._paths_dict is not None:
+            return self._paths_dict
         paths = {}
+        node_xy = self._node_xy
         for p in self.tdm_paths:
-            paths[p] = {'path_x': [n % self.x_dim for n in self.tdm_paths[p].path],
-                        'path_y': [n // self.x_dim for n in self.tdm_paths[p].path],
+            paths[p] = {'path_x': [node_xy[n][0] for n in self.tdm_paths[p].path],
+                        'path_y': [node_xy[n][1] for n in self.tdm_paths[p].path],
                         'path': self.tdm_paths[p].path,
                         'ep_src': self.tdm_paths[p].ep_src,
                         'ep_dest': self.tdm_paths[p].ep_dest,
                         'chid': self.tdm_paths[p].channel,
                         'path_idx': self.tdm_paths[p].path_idx}
+        self._paths_dict = paths
         return paths
 
     def create_channel_dict(self):
         """
         Creates a dictionary with all TDM channels in the NoC. The dictionary
         can be sent to the monitoring GUI.
+        The dictionary is cached until the TDM channels change.
         """
+        if self._channels_dict is not None:
+            return self._channels_dict
         channels = {}
+        node_xy = self._node_xy
         for c in self.tdm_channels:
+            src_x, src_y = node_xy[self.tdm_channels[c].src]
+            dest_x, dest_y = node_xy[self.tdm_channels[c].dest]
             channels[c] = {'pids': self.tdm_channels[c].pids,
                            'errors': self.tdm_channels[c].errors,
-                           'src_x': self.tdm_channels[c].src % self.x_dim,
-                           'src_y': self.tdm_channels[c].src // self.x_dim,
-                           'dest_x': self.tdm_channels[c].dest % self.x_dim,
-                           'dest_y': self.tdm_channels[c].dest // self.x_dim,
+                           'src_x': src_x,
+                           'src_y': src_y,
+                           'dest_x': dest_x,
+                           'dest_y': dest_y,
                            'ep_src': self.tdm_channels[c].ep_src,
                            'ep_dest': self.tdm_channels[c].ep_dest}
+        self._channels_dict = channels
         return channels
 
     def create_tdm_channel(self, src, dest, numslots=1, autopaths=True):
@@ -248,12 +313,15 @@ class CtrlModClient(osd.Hostmod):
         if autopaths:
             path_A = find_path_A(self.x_dim, src, dest)
             path_B = find_path_B(self.x_dim, self.y_dim, src, dest)
-            start_slots_A = self.tdm_info.get_free_slots(path_A, ep_src, ep_dest, 0, numslots)
-            start_slots_B = self.tdm_info.get_free_slots(path_B, ep_src, ep_dest, 1, numslots)
+            start_slots_A, start_slots_B = self.tdm_info.get_free_slots_batched(
+                [(path_A, 0), (path_B, 1)], ep_src, ep_dest, numslots)
             if len(start_slots_A) == 0 or len(start_slots_B) == 0:
                 return -2
-            pid_A = self._configure_tdm_path(path_A, start_slots_A, ep_src, ep_dest, 0)
-            pid_B = self._configure_tdm_path(path_B, start_slots_B, ep_src, ep_dest, 1)
+            # Both paths use different links and slots and are configured
+            # with a single stream of events
+            pid_A, payloads_A = self._prepare_tdm_path(path_A, start_slots_A, ep_src, ep_dest, 0)
+            pid_B, payloads_B = self._prepare_tdm_path(path_B, start_slots_B, ep_src, ep_dest, 1)
+            self._send_events(payloads_A + payloads_B)
 
         chid = self.nxt_chid
         self.tdm_channels[chid] = TDMChannel(src, dest, ep_src, ep_dest, numslots)
@@ -267,6 +335,7 @@ class CtrlModClient(osd.Hostmod):
             path_idx = self.tdm_channels[chid].add_path(self.tdm_paths[pid_B], pid_B)
             self.tdm_paths[pid_B].assign_channel(chid, path_idx)
 
+        self._invalidate_dicts()
         return chid
 
     def delete_tdm_channel(self, chid):
@@ -274,9 +343,10 @@ class CtrlModClient(osd.Hostmod):
         Clears all TDM paths associated with a channel and deletes the channel.
         """
         if chid in self.tdm_channels:
-            for p in range(len(self.tdm_channels[chid].pids)):
-                self._clear_tdm_path(self.tdm_channels[chid].pids[p])
+            for pid in self.tdm_channels[chid].pids:
+                self._clear_tdm_path(pid)
             del self.tdm_channels[chid]
+            self._invalidate_dicts()
 
     def add_path_to_channel(self, chid, path_idx, path):
         retval = 2
@@ -300,37 +370,32 @@ class CtrlModClient(osd.Hostmod):
                         retval = 1
                 else:
                     retval = 0
+                    self._invalidate_dicts()
         return retval
 
     def remove_path_from_channel(self, chid, path_idx):
         pid = self.tdm_channels[chid].clear_path(path_idx)
         self._clear_tdm_path(pid)
 
-    def _configure_tdm_path(self, path, start_slots, ep_src, ep_dest, link):
+    def _prepare_tdm_path(self, path, start_slots, ep_src, ep_dest, link):
+        """
+        Add a new TDM path and return its ID together with the payloads of the
+        events that configure it. The events still need to be sent.
+        """
         # Add a new TDM path to the list
         pid = self.nxt_pid
         self.tdm_paths[pid] = TDMPath(path, start_slots, link, ep_src, ep_dest)
         self.nxt_pid += 1
-        # Configure path
-        for slot in start_slots:
-            self._configure_slot_table(self.tdm_paths[pid].path[0], link, slot, ep_src, pid, True)
-            currslot = slot
-            hop = 0
-            in_port = link + 4
-            while hop < len(path):
-                if hop < len(path) - 1:
-                    c_node = path[hop]
-                    n_node = path[hop+1]
-                    out_port = 0 if c_node - self.x_dim == n_node else 1 if c_node + 1 == n_node else 2 if c_node + self.x_dim == n_node else 3
-                else:
-                    out_port = link + 4
-                self._configure_slot_table(path[hop], out_port, currslot, in_port, pid)
-                currslot = (currslot + 1) % self.slot_table_size
-                hop += 1
-                in_port = 0 if out_port == 2 else 1 if out_port == 3 else 2 if out_port == 0 else 3
-            self._configure_slot_table(path[-1], link + 2, currslot, ep_dest, pid, True)
-        # Enable link
-        self._configure_ep_link(path[0], ep_src, link)
+        self._invalidate_dicts()
+        # Configure path, enable link with the last entry
+        entries = get_slot_table_entries(self.x_dim, self.slot_table_size, path,
+                                         start_slots, link, ep_src, ep_dest)
+        self._set_table_entries(entries, pid)
+        return pid, self._path_payloads(entries, path[0], ep_src, link, True)
+
+    def _configure_tdm_path(self, path, start_slots, ep_src, ep_dest, link):
+        pid, payloads = self._prepare_tdm_path(path, start_slots, ep_src, ep_dest, link)
+        self._send_events(payloads)
         return pid
 
     def configure_tdm_path_raw(self, path, slots, ep_src, ep_dest, link):
@@ -340,25 +405,11 @@ class CtrlModClient(osd.Hostmod):
         The paths are also not given ID.
         """
         #print("{}: Configure path {}, slots {}, ep_src {}, ep_dest {}, link {}".format(MOD, path, slots, ep_src, ep_dest, link))
-        for slot in slots:
-            self._configure_slot_table(path[0], link, slot, ep_src, ni=True)
-            currslot = slot
-            hop = 0
-            in_port = link + 4
-            while hop < len(path):
-                if hop < len(path) - 1:
-                    c_node = path[hop]
-                    n_node = path[hop+1]
-                    out_port = 0 if c_node - self.x_dim == n_node else 1 if c_node + 1 == n_node else 2 if c_node + self.x_dim == n_node else 3
-                else:
-                    out_port = link + 4
-                self._configure_slot_table(path[hop], out_port, currslot, in_port)
-                currslot = (currslot + 1) % self.slot_table_size
-                hop += 1
-                in_port = 0 if out_port == 2 else 1 if out_port == 3 else 2 if out_port == 0 else 3
-            self._configure_slot_table(path[-1], link + 2, currslot, ep_dest, ni=True)
-        # Enable link
-        self._configure_ep_link(path[0], ep_src, link)
+        entries = get_slot_table_entries(self.x_dim, self.slot_table_size, path,
+                                         slots, link, ep_src, ep_dest)
+        # Enable link with the last entry
+        self._send_events(self._path_payloads(entries, path[0], ep_src, link, True))
+        self._set_table_entries(entries, None)
 
     def _clear_tdm_path(self, pid):
         if pid not in self.tdm_paths:
@@ -369,40 +420,30 @@ class CtrlModClient(osd.Hostmod):
         link = self.tdm_paths[pid].link
         ep_src = self.tdm_paths[pid].ep_src
         ep_dest = self.tdm_paths[pid].ep_dest
-        # Deactivate link
-        self._configure_ep_link(path[0], ep_src, link, False)
-        # Clear path
-        for slot in start_slots:
-            self._configure_slot_table(path[0], link, slot, EMPTY, None, True)
-            currslot = slot
-            hop = 0
-            in_port = link + 4
-            while hop < len(path):
-                if hop < len(path) - 1:
-                    c_node = path[hop]
-                    n_node = path[hop+1]
-                    out_port = 0 if c_node - self.x_dim == n_node else 1 if c_node + 1 == n_node else 2 if c_node + self.x_dim == n_node else 3
-                else:
-                    out_port = link + 4
-                self._configure_slot_table(path[hop], out_port, currslot, EMPTY, None)
-                currslot = (currslot + 1) % self.slot_table_size
-                hop += 1
-                in_port = 0 if out_port == 2 else 1 if out_port == 3 else 2 if out_port == 0 else 3
-            self._configure_slot_table(path[-1], link + 2, currslot, EMPTY, None, True)
+        # Clear path, the link is deactivated with the first entry
+        entries = get_slot_table_entries(self.x_dim, self.slot_table_size, path,
+                                         start_slots, link, ep_src, ep_dest, clear=True)
+        self._send_events(self._path_payloads(entries, path[0], ep_src, link, False))
+        self._set_table_entries(entries, None)
         # Delete TDM path entry
         del self.tdm_paths[pid]
+        self._invalidate_dicts()
         return True
 
     def configure_faults(self, node, link, set_fault=True):
         """
         Sets or clears a fault on a specified link.
+        Nothing is sent if the fault is already set or cleared.
         """
+        current = self.fault_vector[node]
         if set_fault:
-            self.fault_vector[node] |= 0x1 << link
+            new = current | (0x1 << link)
         else:
-            self.fault_vector[node] = self.fault_vector[node] & ~(1 << link)
-        event_pkt = self._create_event_pkt(FAULT_CONFIG)
-        event_pkt.payload.append((node << 8) | (self.fault_vector[node] & 0xff))
+            new = current & ~(1 << link)
+        if new == current:
+            return
+        self.fault_vector[node] = new
+        event_pkt = self._create_event_pkt((FAULT_CONFIG, (node << 8) | (self.fault_vector[node] & 0xff)))
         self.hm.event_send(event_pkt)
 
     def receive_handler(self, pkt):
@@ -432,18 +473,21 @@ class CtrlModClient(osd.Hostmod):
         # Handle packets from the NCM
         if pkt.src == self.module_diaddr:
             sub_id = pkt.payload[0] & 0b11
+            if sub_id not in self._handlers:
+                print("{}: Invalid sub-id: {}.".format(MOD, pkt.payload[0]))
+                return
+            handler = self._handlers[sub_id]
+            # Nothing to do if no handler is registered
+            if handler is None:
+                return
             # Read payload into list object
             payload_lst = list(pkt.payload)
-            if sub_id == SUB_ID_FD:
-                if self._fd_handler is not None:
-                    self._fd_handler(payload_lst)
-            elif sub_id == SUB_ID_UTIL:
-                if self._util_handler is not None:
-                    try:
-                        self._util_handler(payload_lst)
-                    except Exception:
-                        print("{}: error when calling handler".format(MOD))
+            if sub_id == SUB_ID_UTIL:
+                try:
+                    handler(payload_lst)
+                except Exception:
+                    print("{}: error when calling handler".format(MOD))
             else:
-                print("{}: Invalid sub-id: {}.".format(MOD, pkt.payload[0]))
+                handler(payload_lst)
         else:
             print("{}: Invalid packet source '{}', expected '{}'.".format(MOD, pkt.src, self.module_diaddr))
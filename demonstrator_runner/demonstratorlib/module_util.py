@@ -0,0 +1,48 @@
+"""
+Copyright (c) 2019-2023 by the author(s)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+=============================================================================
+
+Helper functions shared by the clients of debug modules on the target.
+
+Author(s):
+  Max Koenen <max.koenen@tum.de>
+
+"""
+
+
+def reg_read_many(hostmod, diaddr, reg_addrs):
+    """
+    Read several registers of the module at 'diaddr' and return their values
+    as a list. The hostmod only supports blocking single register reads, so
+    the requests are issued back to back without processing in between.
+    """
+    reg_read = hostmod.reg_read
+    return [reg_read(diaddr, reg_addr) for reg_addr in reg_addrs]
+
+
+def event_header(src, dest, type_sub=0):
+    """
+    Return the header fields of event packets from 'src' to 'dest'. They
+    never change once the hostmod is connected, so clients create them once
+    and reuse them for every packet.
+    """
+    return {'src': src, 'dest': dest, 'type': 2, 'type_sub': type_sub}
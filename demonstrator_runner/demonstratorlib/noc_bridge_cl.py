@@ -29,9 +29,11 @@ Author(s):
 
 """
 
+import numpy as np
 import osd
+from array import array
 from demonstratorlib.constants import *
-from math import ceil
+from demonstratorlib.module_util import reg_read_many, event_header
 
 
 REG_RD_TILE = 0x200
@@ -70,7 +72,14 @@ class NoCBridgeClient(osd.Hostmod):
         self.num_tdm_ep = None
         self.max_tdm_msg_len = None
         self.dr_enabled = None
+        self.routing_table = None
+        # Specialized implementations of '_packetize' for common widths
+        self._packetizers = {8: self._packetize_w8, 16: self._packetize_w16, 32: self._packetize_w32}
+        # Header flits by (pkt_class, specific, ep, dest)
+        self._header_cache = {}
         self.connect()
+        # 'type_sub' 1 marks continued packets
+        self._evt_headers = tuple(event_header(self.diaddr, self.nb_diaddr, type_sub) for type_sub in (0, 1))
         self._read_parameters()
         self.connect_debug_module()
 
@@ -115,77 +124,97 @@ class NoCBridgeClient(osd.Hostmod):
         """
         Read all parameters from the module.
         """
-        self.tile = self.reg_read(self.nb_diaddr, REG_RD_TILE)
-        #print(self.tile)
-        self.max_di_pkt_len = self.reg_read(self.nb_diaddr, REG_RD_MAX_DI_PKT_LEN)
-        #print(self.max_di_pkt_len)
-        self.noc_width = self.reg_read(self.nb_diaddr, REG_RD_NOC_WIDTH)
-        #print(self.noc_width)
-        self.num_links = self.reg_read(self.nb_diaddr, REG_RD_NUM_LINKS)
-        #print(self.num_links)
-        self.num_be_ep = self.reg_read(self.nb_diaddr, REG_RD_NUM_EP_BE)
-        #print(self.num_be_ep)
-        self.max_be_pkt_len = self.reg_read(self.nb_diaddr, REG_RD_MAX_BE_PKT_LEN)
-        #print(self.max_be_pkt_len)
-        self.num_tdm_ep = self.reg_read(self.nb_diaddr, REG_RD_NUM_EP_TDM)
-        #print(self.num_tdm_ep)
-        self.max_tdm_msg_len = self.reg_read(self.nb_diaddr, REG_RD_MAX_TDM_MSG_LEN)
-        #print(self.max_tdm_msg_len)
-        self.dr_enabled = True if self.reg_read(self.nb_diaddr, REG_RD_DR_ENABLED) == 1 else False
-        #print(self.dr_enabled)
+        (self.tile,
+         self.max_di_pkt_len,
+         self.noc_width,
+         self.num_links,
+         self.num_be_ep,
+         self.max_be_pkt_len,
+         self.num_tdm_ep,
+         self.max_tdm_msg_len,
+         dr_enabled) = reg_read_many(self, self.nb_diaddr,
+                                     (REG_RD_TILE,
+                                      REG_RD_MAX_DI_PKT_LEN,
+                                      REG_RD_NOC_WIDTH,
+                                      REG_RD_NUM_LINKS,
+                                      REG_RD_NUM_EP_BE,
+                                      REG_RD_MAX_BE_PKT_LEN,
+                                      REG_RD_NUM_EP_TDM,
+                                      REG_RD_MAX_TDM_MSG_LEN,
+                                      REG_RD_DR_ENABLED))
+        self.dr_enabled = True if dr_enabled == 1 else False
+        # Derived values that are needed for every transfer
+        self._words_per_flit = self.noc_width // 16
+        self._min_be_di_pkt_len = 3 + 1 + self._words_per_flit
 
     def create_routing_table(self, x_dim, y_dim):
-        self.routing_table = []
-        for link in range(self.num_links):
-            self.routing_table.append([])
-            for dest in range(x_dim * y_dim):
-                success, header = self.calculate_header_x_y(self.tile, dest, link, x_dim)
-                if success:
-                    self.routing_table[link].append(header)
-                else:
-                    self.routing_table[link].append(0)
-                    print("{}: Too long path to tile {} from tile {}!".format(MOD, dest, self.tile))
+        """
+        Create the table with the source routing headers to all tiles for
+        each link. The headers of all destinations are calculated at once in
+        the same way as in 'calculate_header_x_y'.
+        """
+        self._header_cache.clear()
+        dests = np.arange(x_dim * y_dim, dtype=np.int64)
+        dx = dests % x_dim - self.tile % x_dim
+        dy = dests // x_dim - self.tile // x_dim
+        hop = np.abs(dx) + np.abs(dy)
+        success = (hop * 3) < self.noc_width - 8
+        # Limit the hops to keep the shifts within 64 bits. This only affects
+        # the headers of too long paths, which are discarded anyway.
+        hops_x = np.minimum(np.abs(dx), 20)
+        hops_y = np.minimum(np.abs(dy), 20)
+        hop = hops_x + hops_y
+        header = (((1 << (hops_x * 3)) - 1) // 7) * np.where(dx > 0, 1, 3)
+        header |= ((((1 << (hops_y * 3)) - 1) // 7) * np.where(dy > 0, 2, 0)) << (hops_x * 3)
+        links = np.arange(self.num_links, dtype=np.int64)[:, np.newaxis]
+        table = header | (((4 + links) & 0x7) << (hop * 3))
+        table[:, ~success] = 0
+        # Keep plain ints in the table as they end up in the event packets
+        self.routing_table = table.tolist()
+        too_long = np.flatnonzero(~success).tolist()
+        for _ in range(self.num_links):
+            for dest in too_long:
+                print("{}: Too long path to tile {} from tile {}!".format(MOD, dest, self.tile))
 
     def calculate_header_x_y(self, source, dest, link, x_dim):
         """
         Calculate header flit for source routing to reach a defined destination
         from a defined source using X Y routing.
         """
-        dest_x = dest % x_dim
-        dest_y = dest // x_dim
-        curr_x = source % x_dim
-        curr_y = source // x_dim
-        hop = 0
-        header = 0
-
-        # Route in x-dim
-        while dest_x != curr_x:
-            if dest_x < curr_x:
-                nhop = 3
-                curr_x -= 1
-            else:
-                nhop = 1
-                curr_x += 1
-            header |= (nhop & 0x7) << (hop * 3)
-            hop += 1
-        # Route in y-dim
-        while dest_y != curr_y:
-            if dest_y < curr_y:
-                nhop = 0
-                curr_y -= 1
-            else:
-                nhop = 2
-                curr_y += 1
-            header |= (nhop & 0x7) << (hop * 3)
-            hop += 1
+        dx = dest % x_dim - source % x_dim
+        dy = dest // x_dim - source // x_dim
+        hops_x = abs(dx)
+        hops_y = abs(dy)
+        hop = hops_x + hops_y
+        # ((1 << 3n) - 1) // 7 has a one in each of the lowest n 3-bit fields,
+        # multiplying it with a next hop repeats that hop n times.
+        # Route in x-dim first, then in y-dim
+        header = (((1 << (hops_x * 3)) - 1) // 7) * (1 if dx > 0 else 3)
+        header |= ((((1 << (hops_y * 3)) - 1) // 7) * (2 if dy > 0 else 0)) << (hops_x * 3)
         header |= ((4 + link) & 0x7) << (hop * 3)
         success = True if ((hop * 3 ) < self.noc_width - 8) else False
         return success, header
 
+    def _make_be_header(self, pkt_class, specific, ep, dest):
+        """
+        Return the header flit of a BE packet to a given destination.
+        The header only depends on the arguments and the routing table, so it
+        is calculated once and then taken from a cache.
+        """
+        key = (pkt_class, specific, ep, dest)
+        header = self._header_cache.get(key)
+        if header is None:
+            if self.dr_enabled:
+                header = (pkt_class & 0x7) << 29 | (specific & 0x1f) << 24 | (ep & 0x1) << 23 | (self.tile & 0x3ff) << 10 | (dest & 0x3ff)
+            else:
+                header = (pkt_class & 0x7) << 29 | (specific & 0x1f) << 24 | self.routing_table[ep][dest]
+            self._header_cache[key] = header
+        return header
+
     def _packetize(self, payload, width, maxlen):
         """
         Creates a list of packets to be sent via the DI. Each of these packets
-        is a list of 16-bit values from the payload list with a given width. The
+        is an array of 16-bit values from the payload list with a given width. The
         number of 16-bit values is limited by 'maxlen' which defines the max.
         packet size in NoC width.
         These packets are later broken down in several DI packets, if necessary.
@@ -194,77 +223,133 @@ class NoCBridgeClient(osd.Hostmod):
         In case of width == 8 or width == 16 the method first ensures that the
         payload are unsigned integers in a valid range (and otherwise sets the
         value to the highest possible).
+        The common widths have specialized implementations, all others are
+        handled by '_packetize_generic'.
+        """
+        packetizer = self._packetizers.get(width)
+        if packetizer is None:
+            return self._packetize_generic(payload, width, maxlen)
+        return packetizer(payload, maxlen)
+
+    def _packetize_w8(self, payload, maxlen):
+        # Pack bytes together, fill last flit with zeros if necessary
+        values = self._clamp_payload(payload, 0xff)
+        num_bytes = len(values)
+        buf = np.zeros(2 + num_bytes + num_bytes % 2, dtype=np.uint8)
+        buf[0] = num_bytes & 0xff
+        buf[1] = (num_bytes >> 8) & 0xff
+        buf[2:2 + num_bytes] = values
+        return self._split_packets(buf.view('<u2'), maxlen)
+
+    def _packetize_w16(self, payload, maxlen):
+        values = self._clamp_payload(payload, 0xffff)
+        words = np.empty(len(values) + 1, dtype=np.uint16)
+        words[0] = (len(values) * 2) & 0xffff
+        words[1:] = values
+        return self._split_packets(words, maxlen)
+
+    def _packetize_w32(self, payload, maxlen):
+        # Fill first NoC flit with zero (lower 16 bits are number of bytes)
+        # and split values in lower and upper 16-bit halves
+        values = np.asarray(payload, dtype=np.int64)
+        words = np.zeros(len(values) * 2 + 2, dtype=np.uint16)
+        words[0] = (len(values) * 4) & 0xffff
+        words[2:] = values.astype('<u4').view('<u2')
+        return self._split_packets(words, maxlen)
+
+    def _packetize_generic(self, payload, width, maxlen):
+        # Fill first NoC flit with zero (lower 16 bits are number of bytes)
+        # and split values in 16-bit chunks
+        words = array('H', ((len(payload) * width // 8) & 0xffff, 0))
+        for value in payload:
+            for word in range(width // 16):
+                words.append((value >> word * 16) & 0xffff)
+        return self._split_packets(words, maxlen)
+
+    def _clamp_payload(self, payload, maxval):
+        """
+        Return the payload as array in which all values greater than 'maxval'
+        are set to 'maxval'.
+        """
+        values = np.asarray(payload, dtype=np.int64)
+        for i in np.flatnonzero(values > maxval):
+            print("{}: Invalid value in payload word {}: {}. The value will be set to {}.".format(MOD, i, payload[i], maxval))
+        return np.minimum(values, maxval)
+
+    def _split_packets(self, words, maxlen):
+        """
+        Split the 16-bit words into packets without exceeding the max. packet
+        length of 'maxlen' NoC flits.
         """
-        # Check values
-        if width == 8 or width == 16:
-            maxval = 0xff if width == 8 else 0xffff
-            for i in range(len(payload)):
-                if payload[i] > maxval:
-                    print("{}: Invalid value in payload word {}: {}. The value will be set to {}.".format(MOD, i, payload[i], maxval))
-                    payload[i] = maxval
-        # Determine number of payload bytes to be sent
-        num_bytes = len(payload) * (width / 8)
-        packed_payload = [[int(num_bytes)]]
-        max_num_words = maxlen * (self.noc_width // 16)
-        if width == 8:
-            # Pack bytes together, fill last flit with zeros if necessary
-            for i in range(int(len(payload)/2)):
-                if len(packed_payload[-1]) == max_num_words:
-                    packed_payload.append([])
-                packed_payload[-1].append((payload[i*2+1] << 8) | payload[i*2])
-            # Add last value in case of odd number of values
-            if len(payload) % 2:
-                if len(packed_payload[-1]) == max_num_words:
-                    packed_payload.append([])
-                packed_payload[-1].append(payload[-1])
-        elif width == 16:
-            # Directly write values to packed_payload but make sure to not
-            # exceed max. DI packet length
-            for i in range(int(len(payload))):
-                if len(packed_payload[-1]) == max_num_words:
-                    packed_payload.append([])
-                packed_payload[-1].append(payload[i])
-        else:
-            # Fill first NoC flit with zero (lower 16 bits are number of bytes)
-            packed_payload[-1].append(0)
-            # Split values in 16-bit chunks
-            for value in range(len(payload)):
-                for word in range(width // 16):
-                    if len(packed_payload[-1]) == max_num_words:
-                        packed_payload.append([])
-                    packed_payload[-1].append((payload[value] >> word * 16) & 0xffff)
-        #print("{}: Packetized width: {}, payload: {}\npacked_payload: {}".format(MOD, width, [hex(h) for h in payload], [[hex(h) for h in list] for list in packed_payload]))
-        return packed_payload
+        if not isinstance(words, array):
+            # Store the 16-bit words in one compact buffer
+            words = array('H', words.astype(np.uint16).tobytes())
+        max_num_words = maxlen * self._words_per_flit
+        return [words[i:i + max_num_words] for i in range(0, len(words), max_num_words)]
 
     def _create_event_pkt(self, type_sub, ep=None, header=None):
         """
         Create an event packet and initialize the header sections.
         """
         event_pkt = osd.Packet()
-        event_pkt.set_header(src=self.diaddr, dest=self.nb_diaddr, type=2, type_sub=type_sub)
-        if ep is not None:
-            event_pkt.payload.append(ep)
+        event_pkt.set_header(**self._evt_headers[type_sub])
         if header is not None:
-            event_pkt.payload.append(header & 0xffff)
-            event_pkt.payload.append((header >> 16) & 0xffff)
+            event_pkt.payload.extend((ep, header & 0xffff, (header >> 16) & 0xffff))
+        elif ep is not None:
+            event_pkt.payload.append(ep)
         return event_pkt
 
+    def event_send_batch(self, pkts):
+        """
+        Send a list of event packets in the given order.
+        """
+        event_send = self.event_send
+        for event_pkt in pkts:
+            event_send(event_pkt)
+
     def tile_ready(self, tile, endpoint):
         """
         Send a control message to a remote BE endpoint to check if it is enabled.
         """
-        # Assemble header flit
-        if self.dr_enabled:
-            if endpoint > 1:
-                print("{}: ep cannot be greater than 1. Currently: {}".format(MOD, endpoint))
-                return
-            header = CTRL_MSG << 29 | (endpoint & 0x1) << 23 | (self.tile & 0x3ff) << 10 | (tile & 0x3ff)
-        else:
-            header = CTRL_MSG << 29 | self.routing_table[endpoint][tile]
+        if self.dr_enabled and endpoint > 1:
+            print("{}: ep cannot be greater than 1. Currently: {}".format(MOD, endpoint))
+            return
+        header = self._make_be_header(CTRL_MSG, 0, endpoint, tile)
         event_pkt = self._create_event_pkt(0, endpoint, header)
         #print("{}: Checking if remote endpoint is ready. Tile {}, endpoint {}".format(MOD, tile, endpoint))
         self.event_send(event_pkt)
 
+    def _build_event_pkts(self, packed_payload, prefix):
+        """
+        Create the DI event packets for a list of NoC packets with 16-bit
+        words. Each NoC packet is split into several DI packets if necessary,
+        the first of which starts with 'prefix'. All but the last DI packet
+        of a NoC packet are marked as continued ('type_sub' 1).
+        """
+        event_pkts = []
+        # Max. number of payload words per DI packet, the first one also
+        # carries the prefix
+        cap = self.max_di_pkt_len - 3
+        first = cap - len(prefix)
+        # Packets are created inline (see '_create_event_pkt')
+        Packet = osd.Packet
+        evt_headers = self._evt_headers
+        for words in packed_payload:
+            # 'first' words in the first and 'cap' in every further DI
+            # packet, i.e. 1 + ceil((len - first) / cap) packets
+            num_di_pkt = 1 + max(0, len(words) - first + cap - 1) // cap
+            word = first
+            for di_pkt in range(num_di_pkt):
+                event_pkt = Packet()
+                event_pkt.set_header(**evt_headers[0 if di_pkt == num_di_pkt - 1 else 1])
+                if di_pkt == 0:
+                    event_pkt.payload.extend(prefix + words[:first])
+                else:
+                    event_pkt.payload.extend(words[word:word + cap])
+                    word += cap
+                event_pkts.append(event_pkt)
+        return event_pkts
+
     def send_data_be(self, endpoint, dest, pkt_class, specific, payload, width=32):
         """
         Send data as BE packets.
@@ -278,38 +363,22 @@ class NoCBridgeClient(osd.Hostmod):
             print("{}: Width of to be sent data must be a multiple of 8. Defined with: {}".format(MOD, width))
             return
         # Ensure that max. DI pkt length is sufficient for EP descriptor and NoC header
-        min_di_pkt_len = 3 + 1 + self.noc_width // 16
-        if self.max_di_pkt_len < min_di_pkt_len:
+        if self.max_di_pkt_len < self._min_be_di_pkt_len:
             print("{}: MAX_DI_PKT_LEN too small for BE header!".format(MOD, self.max_di_pkt_len))
             return
         # Create endpoint descriptor
         ep = endpoint & 0x7fff
-        # Assemble header flit
-        if self.dr_enabled:
-            if ep > 1:
-                print("{}: ep cannot be greater than 1. Currently: {}".format(MOD, ep))
-                return
-            header = (pkt_class & 0x7) << 29 | (specific & 0x1f) << 24 | (ep & 0x1) << 23 | (self.tile & 0x3ff) << 10 | (dest & 0x3ff)
-        else:
-            header = (pkt_class & 0x7) << 29 | (specific & 0x1f) << 24 | self.routing_table[ep][dest]
+        if self.dr_enabled and ep > 1:
+            print("{}: ep cannot be greater than 1. Currently: {}".format(MOD, ep))
+            return
+        header = self._make_be_header(pkt_class, specific, ep, dest)
         #print("{}: Message to tile {} link {}: {}".format(MOD, dest, ep, bin(header)))
         # Create list of packets with 16-bit values for the payload
         packed_payload = self._packetize(payload, width, self.max_be_pkt_len - 1) # -1 since one flit is required for the header
-        # Send event packets until all payload is sent
-        first_pkt_payload = self.max_di_pkt_len - min_di_pkt_len
-        for noc_pkt in range(len(packed_payload)):
-            word = 0
-            num_di_pkt = 1 if len(packed_payload[noc_pkt]) <= first_pkt_payload else 1 + ceil((len(packed_payload[noc_pkt]) - first_pkt_payload) / 9)
-            for di_pkt in range(num_di_pkt):
-                type_sub = 0 if di_pkt == num_di_pkt - 1 else 1
-                # Only the first packet determines the EP & NoC header
-                event_pkt = self._create_event_pkt(type_sub, ep, header) if di_pkt == 0 else self._create_event_pkt(type_sub)
-                while len(event_pkt.payload) < self.max_di_pkt_len - 3:
-                    event_pkt.payload.append(packed_payload[noc_pkt][word])
-                    word += 1
-                    if word == len(packed_payload[noc_pkt]):
-                        break
-                self.event_send(event_pkt)
+        # The first DI packet of each NoC packet carries the EP descriptor and
+        # the 32-bit NoC header
+        prefix = array('H', (ep, header & 0xffff, (header >> 16) & 0xffff))
+        self.event_send_batch(self._build_event_pkts(packed_payload, prefix))
 
     def send_data_tdm(self, endpoint, payload, width=32):
         """
@@ -328,17 +397,6 @@ class NoCBridgeClient(osd.Hostmod):
         #print("{}: TDM message to EP {}: {}".format(MOD, endpoint, [hex(h) for h in payload]))
         # Create list of packets with 16-bit values for the payload
         packed_payload = self._packetize(payload, width, self.max_tdm_msg_len)
-        # Send event packets until all payload is sent
-        for noc_pkt in range(len(packed_payload)):
-            word = 0
-            num_di_pkt = 1 if len(packed_payload[noc_pkt]) <= 8 else 1 + ceil((len(packed_payload[noc_pkt]) - 8) / 9)
-            for di_pkt in range(num_di_pkt):
-                type_sub = 0 if di_pkt == num_di_pkt - 1 else 1
-                # Only the first packet determines the EP
-                event_pkt = self._create_event_pkt(type_sub, ep) if di_pkt == 0 else self._create_event_pkt(type_sub)
-                while len(event_pkt.payload) < self.max_di_pkt_len - 3:
-                    event_pkt.payload.append(packed_payload[noc_pkt][word])
-                    word += 1
-                    if word == len(packed_payload[noc_pkt]):
-                        break
-                self.event_send(event_pkt)
+        # The first DI packet of each NoC message carries the EP descriptor
+        prefix = array('H', (ep,))
+        self.event_send_batch(self._build_event_pkts(packed_payload, prefix))
@@ -33,6 +33,8 @@ import osd
 from demonstratorlib.noc_bridge_cl import NoCBridgeClient, CTRL_MSG
 from demonstratorlib.constants import *
 
+import struct
+from array import array
 import traceback
 import sys
 
@@ -46,12 +48,31 @@ TDM = 1
 
 MOD = None
 
+# 32-bit value from two little endian 16-bit words
+_HEADER = struct.Struct("<I")
+
+
+def _le_buffer(words):
+    """
+    Return a buffer with the given 16-bit words in little endian byte order.
+    """
+    if not isinstance(words, array):
+        words = array('H', words)
+    if sys.byteorder != 'little':
+        words = array('H', words)
+        words.byteswap()
+    return words
+
 
 class NoCGateway:
     def __init__(self, log, host_controller_address, diaddr, x_dim, y_dim):
         global MOD
         MOD = self.__class__.__name__
         self.x_dim = x_dim
+        # Change of the tile index per next hop of a source routing path and
+        # the sources of already seen paths
+        self._hop_deltas = (-x_dim, 1, x_dim, -1)
+        self._source_cache = {}
         # Create NoCBridgeClient for communication with target NoC
         self.noc_bridge = NoCBridgeClient(log, host_controller_address, event_handler=self.receive_handler, diaddr=diaddr)
         # In case of source routing, create routing table in NoCBridgeClient and
@@ -59,12 +80,9 @@ class NoCGateway:
         # received source routed header.
         if not self.noc_bridge.dr_enabled:
             self.noc_bridge.create_routing_table(x_dim, y_dim)
-        # Keep track of enabled BE endpoints
-        self.remote_enabled = []
-        for _ in range(self.noc_bridge.num_links):
-            self.remote_enabled.append([])
-            for _ in range(x_dim * y_dim):
-                self.remote_enabled[-1].append(False)
+        # Keep track of enabled BE endpoints. One bitmap per link in which bit
+        # n is set if the endpoint of tile n is enabled.
+        self.remote_enabled = [0] * self.noc_bridge.num_links
         # Next client ID to be assigned
         self.nxt_cid = 0
         # Nested dictionary that determines which client receives which NoC
@@ -72,34 +90,108 @@ class NoCGateway:
         self.cl_binds = {}
         # Dictionary with references to clients
         self.clients = {}
+        # Compiled form of 'cl_binds': Maps (type, ep, pkt_class, src) of
+        # received packets to a list of (cid, width) of the clients that
+        # receive them. Filled on demand and replaced when bindings change.
+        self._dispatch = {}
+        # Endpoints with bound clients per traffic type, see '_invalidate_dispatch'
+        self._bound_eps = {}
 
     def register_client(self, client):
         self.cl_binds[self.nxt_cid] = None
         self.clients[self.nxt_cid] = client
         self.nxt_cid += 1
+        self._invalidate_dispatch()
         return self.nxt_cid - 1
 
     def unregister_client(self, cid):
         del self.cl_binds[cid]
         del self.clients[cid]
+        self._invalidate_dispatch()
 
     def bind_traffic(self, cid, type=None, ep=None, pkt_class=None, src=None, width=32):
         if cid not in self.clients:
             print("{}: A client with CID {} is not registered!".format(MOD, cid))
         else:
-            self.cl_binds[cid] = {}
-            self.cl_binds[cid]['width'] = width
+            # Assemble the bindings first, the receive handler thread may be
+            # reading 'cl_binds'
+            binds = {}
+            binds['width'] = width
             if type is not None:
-                self.cl_binds[cid][type] = {}
+                binds[type] = {}
                 if ep is not None:
-                    self.cl_binds[cid][type][EP] = ep
+                    binds[type][EP] = ep
                 if pkt_class is not None:
-                    self.cl_binds[cid][type][CLASS] = pkt_class
+                    binds[type][CLASS] = pkt_class
                 if src is not None:
-                    self.cl_binds[cid][type][SRC] = src
+                    binds[type][SRC] = src
+            self.cl_binds[cid] = binds
+            self._invalidate_dispatch()
 
     def unbind_traffic(self, cid):
         self.cl_binds[cid] = None
+        self._invalidate_dispatch()
+
+    def _invalidate_dispatch(self):
+        """
+        Must be called whenever clients or their bindings change.
+        The receive handler runs in another thread and may fill the dispatch
+        table concurrently. Therefore, both the dispatch table and the bound
+        endpoints are replaced by new objects instead of being modified, so
+        that a fill that started before the change only affects the old
+        table.
+        """
+        bound_eps = {}
+        for binds in list(self.cl_binds.values()):
+            if binds is None:
+                continue
+            for type in (BE, TDM):
+                filters = binds.get(type)
+                if filters is None or EP not in filters:
+                    # Client receives packets of all endpoints
+                    bound_eps[type] = None
+                elif type not in bound_eps:
+                    bound_eps[type] = {filters[EP]}
+                elif bound_eps[type] is not None:
+                    bound_eps[type].add(filters[EP])
+        self._dispatch = {}
+        self._bound_eps = bound_eps
+
+    def _any_bound(self, type, ep):
+        """
+        Check if any client is bound to receive packets of the given traffic
+        type and endpoint.
+        """
+        bound_eps = self._bound_eps
+        if type not in bound_eps:
+            return False
+        eps = bound_eps[type]
+        return eps is None or ep in eps
+
+    def _subscribers(self, type, ep, pkt_class=None, src=None):
+        """
+        Return a list of (cid, width) of all clients that receive a packet
+        with the given properties. Clients that don't filter a traffic type
+        receive all packets of that type. TDM packets are only filtered by
+        endpoint.
+        """
+        key = (type, ep, pkt_class, src)
+        dispatch = self._dispatch
+        subscribers = dispatch.get(key)
+        if subscribers is None:
+            subscribers = []
+            for cl, binds in list(self.cl_binds.items()):
+                if binds is None:
+                    continue
+                filters = binds.get(type)
+                if (filters is None or
+                    (EP not in filters or filters[EP] == ep) and
+                    (type != BE or
+                     (CLASS not in filters or filters[CLASS] == pkt_class) and
+                     (SRC not in filters or filters[SRC] == src))):
+                    subscribers.append((cl, binds['width']))
+            dispatch[key] = subscribers
+        return subscribers
 
     def tile_ready(self, tile, endpoint):
         """
@@ -109,9 +201,11 @@ class NoCGateway:
         Note that no message is sent if the endpoint doesn't exist and 'False'
         will always be returned.
         """
-        if self.remote_enabled[endpoint][tile] is False and endpoint < self.noc_bridge.num_be_ep:
+        if (self.remote_enabled[endpoint] >> tile) & 1:
+            return True
+        if endpoint < self.noc_bridge.num_be_ep:
             self.noc_bridge.tile_ready(tile, endpoint)
-        return self.remote_enabled[endpoint][tile]
+        return False
 
     def send_data_be(self, ep, dest, pkt_class, specific, payload, width=32):
         self.noc_bridge.send_data_be(ep, dest, pkt_class, specific, payload, width)
@@ -132,49 +226,48 @@ class NoCGateway:
             return []
         unpacked = []
         idx = 0
+        buf = _le_buffer(payload)
         if type == BE:
-            header = payload[1] << 16 | payload[0]
-            unpacked.append(header)
+            unpacked.extend(_HEADER.unpack_from(buf))
             idx = 2
 
         if width == 8:
-            for i in range(idx, len(payload)):
-                unpacked.append(payload[i] & 0xff)
-                unpacked.append((payload[i] >> 8) & 0xff)
+            unpacked.extend(memoryview(buf).cast('B')[idx * 2:])
         elif width == 16:
             # Nothing to do, just extend unpacked
             unpacked.extend(payload[idx:])
         elif width == 32:
             if len(payload) % 2 != 0:
                 print("{}: Invalid length for 32-bit receive: {} bytes\n{}".format(MOD, len(payload)*2, [hex(i) for i in payload]))
-            for i in range(idx, len(payload), 2):
-                unpacked.append(payload[i] | payload[i+1] << 16)
+            unpacked.extend(struct.unpack_from("<{}I".format((len(payload) - idx) // 2), buf, idx * 2))
         else:
             print("{}: Unsupported width for receiving: {}".format(MOD, width))
         return unpacked
 
     def _find_source(self, sr_path):
+        """
+        Determine the source tile and endpoint from the source routing path of
+        a received packet. Decoded paths are cached, as the number of
+        different paths to this tile is limited.
+        """
+        source = self._source_cache.get(sr_path)
+        if source is not None:
+            return source
+        path = sr_path
         curr_tile = self.noc_bridge.tile
-        ep = -1
-        while ep < 0:
-            nhop = sr_path & 0x7
-            if nhop == 0:
-                curr_tile -= self.x_dim
-            elif nhop == 1:
-                curr_tile += 1
-            elif nhop == 2:
-                curr_tile += self.x_dim
-            elif nhop == 3:
-                curr_tile -= 1
-            elif nhop == 4:
-                ep = 0
-            elif nhop == 5:
-                ep = 1
+        while True:
+            nhop = path & 0x7
+            if nhop < 4:
+                curr_tile += self._hop_deltas[nhop]
+            elif nhop < 6:
+                break
             else:
                 print("{}: Invalid hop: '{}'!".format(MOD, nhop))
                 return None
-            sr_path >>= 3
-        return curr_tile, ep
+            path >>= 3
+        source = (curr_tile, nhop - 4)
+        self._source_cache[sr_path] = source
+        return source
 
     def receive_handler(self, pkt):
         self.receive_event(pkt=pkt)
@@ -187,7 +280,8 @@ class NoCGateway:
         The first word of the payload determines the type (BE or TDM) and the
         endpoint the packet was received on.
         The remaining payload is the NoC packet (including header).
-        Only the NoC packet will be forwarded to the clients.
+        Only the NoC packet will be forwarded to the clients. The payload is
+        only unpacked once per width, but each client gets its own list.
         """
         try:
             if pkt is None:
@@ -202,21 +296,22 @@ class NoCGateway:
                         else:
                             print("{}: {}".format(MOD, e))
                         return
-            if len(pkt.payload) < 3:
+            # Read payload into a compact array (a single pass over the packet)
+            payload_lst = array('H', pkt.payload)
+            if len(payload_lst) < 3:
                 print("{}: Received invalid event packet: {}".format(MOD, pkt))
                 return
-            if (len(pkt.payload) - 1) % 2 != 0:
-                print("{}: Received event packet with invalid payload length: {}, payload: {}.".format(MOD, len(pkt.payload), [hex(h) for h in pkt.payload]))
+            if (len(payload_lst) - 1) % 2 != 0:
+                print("{}: Received event packet with invalid payload length: {}, payload: {}.".format(MOD, len(payload_lst), [hex(h) for h in payload_lst]))
                 return
-            type = (pkt.payload[0] >> 15) & 0x1
-            ep = pkt.payload[0] & 0x7fff
-            # Read payload into list object
-            payload_lst = []
-            for i in range(1, len(pkt.payload)):
-                payload_lst.append(pkt.payload[i])
+            type = (payload_lst[0] >> 15) & 0x1
+            ep = payload_lst[0] & 0x7fff
+            del payload_lst[0]
             #print("{}: Received type: {}, ep: {}, payload: {}".format(MOD, type, ep, [hex(h) for h in payload_lst]))
+            # Clients with the same width share the unpacked payload
+            unpacked_by_width = {}
             if type == BE:
-                header = pkt.payload[2] << 16 | pkt.payload[1]
+                header, = _HEADER.unpack_from(_le_buffer(payload_lst))
                 pkt_class = header >> 29
                 if self.noc_bridge.dr_enabled:
                     src = (header >> 10) & 0x3ff
@@ -224,24 +319,30 @@ class NoCGateway:
                     # Source routed packets can have different source and destination EPs.
                     # For DR packets it is assumed that the source EP is the same as the destination EP.
                     src, ep = self._find_source(header & 0xffffff)
+                # Control packets are always handled, other packets only if a
+                # client could receive them
+                if pkt_class != CTRL_MSG and not self._any_bound(BE, ep):
+                    return
                 # Handle control packets
                 if (pkt_class == CTRL_MSG):
                     #print("{}: Tile {} endpoints {} is enabled".format(MOD, src, ep))
-                    self.remote_enabled[ep][src] = True
+                    self.remote_enabled[ep] |= 1 << src
                 else:
-                    for cl in self.cl_binds:
-                        if ((BE not in self.cl_binds[cl]) or
-                            (EP not in self.cl_binds[cl][BE] or self.cl_binds[cl][BE][EP] == ep) and
-                            (CLASS not in self.cl_binds[cl][BE] or self.cl_binds[cl][BE][CLASS] == pkt_class) and
-                            (SRC not in self.cl_binds[cl][BE] or self.cl_binds[cl][BE][SRC] == src)):
-                            unpacked = self._unpack_payload(payload_lst, type, self.cl_binds[cl]['width'])
-                            self.clients[cl].receive(BE, ep, unpacked, src=src)
+                    subscribers = self._subscribers(BE, ep, pkt_class, src)
+                    for cl, width in subscribers:
+                        unpacked = unpacked_by_width.get(width)
+                        if unpacked is None:
+                            unpacked = unpacked_by_width[width] = self._unpack_payload(payload_lst, type, width)
+                        # Clients may modify the list, so only a single client
+                        # can get the unpacked list itself
+                        self.clients[cl].receive(BE, ep, unpacked if len(subscribers) == 1 else list(unpacked), src=src)
             elif type == TDM:
-                for cl in self.cl_binds:
-                    if ((TDM not in self.cl_binds[cl]) or
-                        (EP not in self.cl_binds[cl][TDM] or self.cl_binds[cl][TDM][EP] == ep)):
-                        unpacked = self._unpack_payload(payload_lst, type, self.cl_binds[cl]['width'])
-                        self.clients[cl].receive(TDM, ep, unpacked)
+                subscribers = self._subscribers(TDM, ep)
+                for cl, width in subscribers:
+                    unpacked = unpacked_by_width.get(width)
+                    if unpacked is None:
+                        unpacked = unpacked_by_width[width] = self._unpack_payload(payload_lst, type, width)
+                    self.clients[cl].receive(TDM, ep, unpacked if len(subscribers) == 1 else list(unpacked))
             else:
                 print("{}: Unknown traffic type: {}!".format(MOD, type))
         except Exception:
@@ -28,59 +28,46 @@ Author(s):
 
 """
 
+from functools import lru_cache
+
+
 def check_valid_path(x_dim, path):
     """
     Check whether or not a given path is valid.
     """
-    valid = True
-    i = 0
-    while valid and i < len(path) - 1:
-        hop = path[i]
-        nhop = path[i+1]
-        valid = True if (nhop == hop + x_dim) or (nhop == hop - x_dim) or (nhop == hop + 1) or (nhop == hop - 1) else False
-        i += 1
-    return valid
+    # Consecutive nodes must be neighbors in x or y direction
+    return all(abs(nhop - hop) in (1, x_dim) for hop, nhop in zip(path, path[1:]))
+
+def _line(start, stop):
+    """
+    Return all coordinates from 'start' to 'stop' (both included).
+    """
+    return range(start, stop + 1) if start <= stop else range(start, stop - 1, -1)
 
 def find_path_x_y(x_dim, curr_x, curr_y, dest_x, dest_y, path):
     """
-    Recursively find path to a destination using x-y-routing.
+    Find path to a destination using x-y-routing and append it to 'path'.
     """
-    path.append(x_dim * curr_y + curr_x)
-    if curr_x == dest_x:
-        if curr_y == dest_y:
-            return path
-        elif curr_y < dest_y:
-            curr_y += 1
-        else:
-            curr_y -= 1
-    elif curr_x < dest_x:
-        curr_x += 1
-    else:
-        curr_x -= 1
-    return find_path_x_y(x_dim, curr_x, curr_y, dest_x, dest_y, path)
+    path.extend(x_dim * curr_y + x for x in _line(curr_x, dest_x))
+    path.extend(x_dim * y + dest_x for y in _line(curr_y, dest_y)[1:])
+    return path
 
 def find_path_y_x(x_dim, curr_x, curr_y, dest_x, dest_y, path):
     """
-    Recursively find path to a destination using y-x-routing.
+    Find path to a destination using y-x-routing and append it to 'path'.
     """
-    path.append(x_dim * curr_y + curr_x)
-    if curr_y == dest_y:
-        if curr_x == dest_x:
-            return path
-        elif curr_x < dest_x:
-            curr_x += 1
-        else:
-            curr_x -= 1
-    elif curr_y < dest_y:
-        curr_y += 1
-    else:
-        curr_y -= 1
-    return find_path_y_x(x_dim, curr_x, curr_y, dest_x, dest_y, path)
+    path.extend(x_dim * y + curr_x for y in _line(curr_y, dest_y))
+    path.extend(x_dim * dest_y + x for x in _line(curr_x, dest_x)[1:])
+    return path
 
 def find_path_A(x_dim, source, dest):
     """
     Find shortest path from any source to any destination using x-y-routing.
     """
+    return list(_find_path_A(x_dim, source, dest))
+
+@lru_cache(maxsize=None)
+def _find_path_A(x_dim, source, dest):
     curr_x = source % x_dim
     curr_y = source // x_dim
     dest_x = dest % x_dim
@@ -97,6 +84,10 @@ def find_path_B(x_dim, y_dim, source, dest):
     case a step is made in x-direction, y-x-routing is used afterwards,
     otherwise x-y-routing is used.
     """
+    return list(_find_path_B(x_dim, y_dim, source, dest))
+
+@lru_cache(maxsize=None)
+def _find_path_B(x_dim, y_dim, source, dest):
     curr_x = source % x_dim
     curr_y = source // x_dim
     dest_x = dest % x_dim
@@ -28,16 +28,37 @@ Author(s):
 
 """
 
+import atexit
+import ctypes
+import os
+import platform
+import queue
+import select
 import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import psutil
 import osd
 from time import sleep
 from demonstratorlib.constants import *
 
+# Number of the pidfd_open system call on the architectures this runs on
+SYS_PIDFD_OPEN = 434
+SYS_PIDFD_OPEN_MACHINES = ('x86_64', 'aarch64', 'arm64')
+
+# Max. number of memories that are loaded in parallel
+MAX_LOAD_WORKERS = 8
+
+# Max. number of STM loggers that are started or stopped in parallel
+MAX_STM_WORKERS = 8
+
 # Hostctrl, gateway, and hostmod instances
 _hostctrl = None
 _gw = None
 _hostmod = None
+# SystemManager instance of the session
+_sys_manager = None
 
 
 def connect_target(log, backend):
@@ -64,12 +85,11 @@ def disconnect_target(stm_loggers):
     # Tear down
     #print("Ending observation, shutting down")
     # STM loggers
-    for l in stm_loggers:
-        l.stop()
-        l.disconnect()
-        assert(not l.is_connected())
+    _run_parallel(_stop_stm_logger, stm_loggers)
 
-    # Host module
+    # Host modules
+    if _sys_manager is not None:
+        _sys_manager.disconnect()
     _hostmod.disconnect()
     assert(not _hostmod.is_connected())
 
@@ -80,34 +100,76 @@ def disconnect_target(stm_loggers):
     # Host controller
     _hostctrl.stop()
 
-def load_memory(log, args, x_dim, y_dim, verify=False):
-    # Load program memories
-    memaccess = osd.MemoryAccess(log, LOCALHOST)
-    memaccess.connect()
-    memaccess.cpus_stop(0)
-
-    memories = memaccess.find_memories(0)
-
-    print("Loading memories")
-    # Tile - memory index offset in case not all tiles have a memory (I/O Tile)
-    offset = 0
-    topology = "{}x{}".format(x_dim, y_dim)
-    for i in range(len(memories)):
-        # Increase offset if tile has no memory
-        while MAPPING[topology][i+offset] == "I/O":
-            offset += 1
-        if MAPPING[topology][i+offset] == "LCT":
-            elf = args.lct_elf
-        elif MAPPING[topology][i+offset] == "HCT":
-            elf = args.hct_elf
-        if elf != "":
-            print("  Memory of tile {}".format(i+offset))
-            memaccess.loadelf(memories[i], elf, verify)
-
-    print("Starting CPUs")
-    memaccess.cpus_start(0)
-    memaccess.disconnect()
+def _get_tile_elfs(args, x_dim, y_dim):
+    """
+    Return a list of (tile, elf) for all tiles with a memory, in the order in
+    which the memories are found in the system. I/O tiles have no memory.
+    'elf' is empty if no program is to be loaded into the tile.
+    """
+    mapping = MAPPING["{}x{}".format(x_dim, y_dim)]
+    elfs = {"LCT": args.lct_elf, "HCT": args.hct_elf}
+    return [(tile, elfs.get(role, "")) for tile, role in enumerate(mapping) if role != "I/O"]
+
+def _prefetch_files(paths):
+    """
+    Ask the OS to read the given files into the page cache in the
+    background, if supported. Errors are ignored, files that cannot be opened
+    are reported when they are actually used.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+def _load_elfs(memaccesses, jobs, verify):
+    """
+    Load ELF files into several memories in parallel. 'jobs' is a list of
+    (tile, memory, elf), 'memaccesses' a list of connected MemoryAccess
+    hostmods. The loads are mostly waiting for the target, so they are
+    overlapped in a thread pool with one worker per hostmod, as a hostmod
+    must not be used by several threads at once.
+    """
+    if not jobs:
+        return
+    # The same few ELF files are loaded into many memories
+    _prefetch_files({elf for _, _, elf in jobs})
+    for tile, _, _ in jobs:
+        print("  Memory of tile {}".format(tile))
+    idle = queue.Queue()
+    for memaccess in memaccesses:
+        idle.put(memaccess)
+
+    def load(job):
+        _, memory, elf = job
+        memaccess = idle.get()
+        try:
+            memaccess.loadelf(memory, elf, verify)
+        finally:
+            idle.put(memaccess)
+
+    with ThreadPoolExecutor(max_workers=min(len(memaccesses), len(jobs))) as executor:
+        # Consume the results to raise errors of the workers
+        list(executor.map(load, jobs))
 
+def load_memory(log, args, x_dim, y_dim, verify=False):
+    """
+    Load program memories and start the CPUs. The hostmods of the session's
+    SystemManager are used instead of connecting new ones for each call.
+    """
+    sys_manager = get_system_manager(log, args, x_dim, y_dim, verify)
+    sys_manager.load_memories()
+    sys_manager.start_cpus()
+
+@lru_cache(maxsize=256)
 def _get_module_name(vendor, type):
     if vendor == 1 and OSD_MODULE_TYPE_STD_LIST[type]:  # vendor == OSD
         return OSD_MODULE_TYPE_STD_LIST[type]
@@ -120,14 +182,16 @@ def _get_module_name(vendor, type):
 def enumerate_modules(modules):
     print("Modules in Demonstrator")
     for module in modules:
+        vendor = module['vendor']
+        type = module['type']
         print("  {}.{}: {} {} v{} ({}.{})".format(
               0,
               module['addr'],
-              OSD_MODULE_VENDOR_LIST[module['vendor']][0],
-              _get_module_name(module['vendor'], module['type'])[0],
+              OSD_MODULE_VENDOR_LIST[vendor][0],
+              _get_module_name(vendor, type)[0],
               module['version'],
-              module['vendor'],
-              module['type']))
+              vendor,
+              type))
 
 def setup_stm_logging(log, modules):
     stm_loggers = []
@@ -138,25 +202,107 @@ def setup_stm_logging(log, modules):
         l = osd.SystraceLogger(log, LOCALHOST, stm_mod_addr)
         l.sysprint_log = 'stdout.{:03d}.log'.format(stm_mod_addr)
         l.event_log = 'events.{:03d}.log'.format(stm_mod_addr)
-        l.connect()
-        l.start()
         stm_loggers.append(l)
+    # Each logger is a separate hostmod, so they can connect concurrently
+    _run_parallel(_start_stm_logger, stm_loggers)
     return stm_loggers
 
+def _start_stm_logger(l):
+    l.connect()
+    l.start()
+
+def _stop_stm_logger(l):
+    l.stop()
+    l.disconnect()
+    assert(not l.is_connected())
+
+def _run_parallel(func, items):
+    """
+    Call 'func' for all items in a thread pool and wait until all calls are
+    done. Errors of the calls are raised.
+    """
+    if not items:
+        return
+    with ThreadPoolExecutor(max_workers=min(MAX_STM_WORKERS, len(items))) as executor:
+        list(executor.map(func, items))
+
+def _pidfd_open(pid):
+    """
+    Return a file descriptor referring to the process with the given pid that
+    becomes readable once the process terminates, or 'None' if the kernel
+    (Linux >= 5.3) or Python doesn't support this.
+    """
+    if hasattr(os, 'pidfd_open'):
+        try:
+            return os.pidfd_open(pid)
+        except OSError:
+            return None
+    if not sys.platform.startswith('linux') or platform.machine() not in SYS_PIDFD_OPEN_MACHINES:
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        pidfd = libc.syscall(SYS_PIDFD_OPEN, pid, 0)
+    except (OSError, AttributeError):
+        return None
+    return pidfd if pidfd >= 0 else None
+
+def _wait_for_pid(pid):
+    """
+    Block until the process with the given pid has terminated. The process
+    does not have to be a child of this process.
+    """
+    pidfd = _pidfd_open(pid)
+    if pidfd is None:
+        # Fall back to polling
+        while psutil.pid_exists(pid):
+            sleep(1)
+        return
+    try:
+        select.select([pidfd], [], [])
+    finally:
+        os.close(pidfd)
+
 def wait_for_sim_proc(proc):
     if proc:
         # Get pid from process name
         pid = int(subprocess.run(['pgrep', proc], stdout=subprocess.PIPE).stdout)
         print("Wait for simulation process to finish (pid: {}).".format(pid))
-        while psutil.pid_exists(pid):
-            sleep(1)
+        _wait_for_pid(pid)
     else:
         sleep(SIM_EXEC_TIME_SEC)
 
+def get_system_manager(log, args, x_dim, y_dim, verify=False):
+    """
+    Return the SystemManager of the session. It is only created on the first
+    call so that its hostmod stays connected across calls.
+    """
+    global _sys_manager
+    if _sys_manager is None:
+        _sys_manager = SystemManager(log, args, x_dim, y_dim, verify)
+    else:
+        _sys_manager.args = args
+        _sys_manager.verify = verify
+    return _sys_manager
+
+def _disconnect_at_exit():
+    """
+    Disconnect the hostmods that are still connected when the program exits,
+    e.g. because it was not shut down via 'disconnect_target'.
+    """
+    if _sys_manager is not None:
+        _sys_manager.disconnect()
+    if _hostmod is not None and _hostmod.is_connected():
+        _hostmod.disconnect()
+
+atexit.register(_disconnect_at_exit)
+
 class SystemManager():
     def __init__(self, log, args, x_dim, y_dim, verify=False):
+        self.log = log
         self.hm = osd.MemoryAccess(log, LOCALHOST)
         self.hm.connect()
+        # Additional hostmods for loading memories in parallel
+        self._load_hms = []
         self.args = args
         self.verify = verify
         self.cpus_running = True
@@ -166,6 +312,24 @@ class SystemManager():
         # Load memories
         #self.load_memories()
 
+    def _get_load_hostmods(self, num_jobs):
+        """
+        Return the hostmods used for loading memories in parallel. 'hm' is
+        one of them, the additional ones are connected on first use and kept
+        until 'disconnect' is called.
+        """
+        while len(self._load_hms) < min(MAX_LOAD_WORKERS, num_jobs) - 1:
+            hm = osd.MemoryAccess(self.log, LOCALHOST)
+            hm.connect()
+            self._load_hms.append(hm)
+        return [self.hm] + self._load_hms
+
+    def disconnect(self):
+        for hm in [self.hm] + self._load_hms:
+            if hm.is_connected():
+                hm.disconnect()
+        self._load_hms = []
+
     def stop_cpus(self):
         print("{}: Stopping CPUs".format(self.__class__.__name__))
         self.hm.cpus_stop(0)
@@ -191,18 +355,6 @@ class SystemManager():
         memories = self.hm.find_memories(0)
 
         print("{}: Loading memories".format(self.__class__.__name__))
-        # Tile - memory index offset in case not all tiles have a memory (I/O Tile)
-        offset = 0
-        topology = "{}x{}".format(self.x_dim, self.y_dim)
-        for i in range(len(memories)):
-            # Increase offset if tile has no memory
-            while MAPPING[topology][i+offset] == "I/O":
-                offset += 1
-            if MAPPING[topology][i+offset] == "LCT":
-                elf = self.args.lct_elf
-            elif MAPPING[topology][i+offset] == "HCT":
-                elf = self.args.hct_elf
-            if elf != "":
-                print("  Memory of tile {}".format(i+offset))
-                self.hm.loadelf(memories[i], elf, self.verify)
+        jobs = [(tile, memory, elf) for memory, (tile, elf) in zip(memories, _get_tile_elfs(self.args, self.x_dim, self.y_dim)) if elf != ""]
+        _load_elfs(self._get_load_hostmods(len(jobs)), jobs, self.verify)
         print("{}: Memories loaded".format(self.__class__.__name__))
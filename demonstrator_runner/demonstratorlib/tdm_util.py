@@ -28,10 +28,127 @@ Author(s):
 
 """
 
+import numpy as np
 from demonstratorlib.constants import *
 from demonstratorlib.path_util import *
 
 
+def get_slot_mask(slot_table_size):
+    """
+    Returns the bit mask to wrap slot indices if the slot table size is a power
+    of two, otherwise 'None'.
+    """
+    if slot_table_size > 0 and slot_table_size & (slot_table_size - 1) == 0:
+        return slot_table_size - 1
+    return None
+
+
+def get_out_ports(x_dim):
+    """
+    Returns a dictionary that maps the difference between the next and the
+    current node of a path to the output port of the router (0: north,
+    1: east, 2: south, 3: west).
+    The entries are inserted in reverse order of precedence so that north and
+    east win if the differences coincide (x_dim == 1).
+    """
+    return {-1: 3, x_dim: 2, 1: 1, -x_dim: 0}
+
+
+def get_path_slot_tables(path, link, out_ports):
+    """
+    Returns the slot tables used by a TDM path as index arrays into the slot
+    table arrays of TDMinfo: node, router/NI, port, and the slot offset
+    relative to the start slot. The tables are the outgoing NI slot table at
+    the source, the router slot tables along the path, and the incoming NI
+    slot table at the destination.
+    """
+    hops = len(path)
+    nodes = np.empty(hops + 2, dtype=np.intp)
+    nodes[0] = path[0]
+    nodes[1:-1] = path
+    nodes[-1] = path[-1]
+    ni = np.zeros(hops + 2, dtype=np.intp)
+    ni[0] = ni[-1] = 1
+    ports = np.empty(hops + 2, dtype=np.intp)
+    ports[0] = link
+    ports[1:-2] = [out_ports.get(n_node - c_node, 3) for c_node, n_node in zip(path, path[1:])]
+    ports[-2] = link + 4
+    ports[-1] = link + 2
+    offsets = np.arange(-1, hops + 1, dtype=np.intp)
+    offsets[0] = 0
+    return nodes, ni, ports, offsets
+
+
+def _used_slot_entries(cfg, tables):
+    """
+    Returns a boolean array in which row i is 'True' for every start slot for
+    which slot table i of the given slot tables (see 'get_path_slot_tables')
+    is not EMPTY. All slot tables and start slots are checked in a single
+    pass.
+    """
+    nodes, ni, ports, offsets = tables
+    slot_table_size = cfg.shape[-1]
+    # Row i holds the entries of table i, columns are the start slots
+    slots = (np.arange(slot_table_size) + offsets[:, np.newaxis]) % slot_table_size
+    entries = cfg[nodes[:, np.newaxis], ni[:, np.newaxis], ports[:, np.newaxis], slots]
+    return entries != EMPTY
+
+
+def _used_start_slots(cfg, tables):
+    """
+    Returns a boolean array that is 'True' for every start slot for which at
+    least one of the given slot tables is not EMPTY.
+    """
+    return _used_slot_entries(cfg, tables).any(axis=0)
+
+
+def _first_slots(free, numslots):
+    """
+    Returns the first 'numslots' free start slots as a list, or an empty list
+    if not enough slots are free.
+    """
+    start_slots = np.flatnonzero(free)
+    if len(start_slots) < numslots:
+        return []
+    return start_slots[:numslots].tolist()
+
+
+def get_slot_table_entries(x_dim, slot_table_size, path, start_slots, link,
+                           ep_src, ep_dest, clear=False):
+    """
+    Create the list of slot table entries that need to be written to configure
+    (or clear) a TDM path.
+    Each entry is a tuple (node, ni, port, slot, config). For every start slot
+    the list holds the entry of the outgoing NI slot table at the source, one
+    entry per router along the path, and the entry of the incoming NI slot
+    table at the destination.
+    If 'clear' is set, all entries are set to EMPTY.
+    """
+    entries = []
+    last_hop = len(path) - 1
+    slot_mask = get_slot_mask(slot_table_size)
+    # Choose how to wrap around the slot table once, a mask is cheaper
+    if slot_mask is not None:
+        next_slot = lambda slot: (slot + 1) & slot_mask
+    else:
+        next_slot = lambda slot: (slot + 1) % slot_table_size
+    out_ports = get_out_ports(x_dim)
+    for slot in start_slots:
+        entries.append((path[0], True, link, slot, EMPTY if clear else ep_src))
+        currslot = slot
+        in_port = link + 4
+        for hop in range(len(path)):
+            if hop < last_hop:
+                out_port = out_ports.get(path[hop+1] - path[hop], 3)
+            else:
+                out_port = link + 4
+            entries.append((path[hop], False, out_port, currslot, EMPTY if clear else in_port))
+            currslot = next_slot(currslot)
+            in_port = 0 if out_port == 2 else 1 if out_port == 3 else 2 if out_port == 0 else 3
+        entries.append((path[-1], True, link + 2, currslot, EMPTY if clear else ep_dest))
+    return entries
+
+
 class TDMPath():
     """
     Helper class to handle a single TDM path.
@@ -39,6 +156,8 @@ class TDMPath():
     """
     def __init__(self, path, slots, link, ep_src, ep_dest):
         self.path = path
+        # Directed links used by the path
+        self._edges = frozenset(zip(path, path[1:]))
         self.slots = slots
         self.link = link
         self.ep_src = ep_src
@@ -67,12 +186,7 @@ class TDMPath():
             self.path[0] != tdm_path.path[0] or
             self.path[-1] != tdm_path.path[-1]):
             return False
-        for hop_self in range(len(self.path)-1):
-            for hop_other in range(len(tdm_path.path)-1):
-                if (self.path[hop_self] == tdm_path.path[hop_other] and
-                    self.path[hop_self+1] == tdm_path.path[hop_other+1]):
-                    return False
-        return True
+        return self._edges.isdisjoint(tdm_path._edges)
 
 
 class TDMChannel():
@@ -82,6 +196,8 @@ class TDMChannel():
     A channel has two disjoint paths.
     Two channels in opposite direction make up a connection
     """
+    __slots__ = ('paths', 'pids', 'errors', 'src', 'dest', 'ep_src', 'ep_dest', 'numslots')
+
     def __init__(self, src, dest, ep_src, ep_dest, numslots):
         self.paths = [None, None]
         self.pids = [None, None]
@@ -105,21 +221,13 @@ class TDMChannel():
         Check if source, destination, endpoints, and number of slots match the
         channel parameters.
         """
-        if (path.path[0] != self.src or
-            path.path[-1] != self.dest or
-            path.ep_src != self.ep_src or
-            path.ep_dest != self.ep_dest or
-            len(path.slots) != self.numslots):
-            return False
-        return True
+        return ((path.path[0], path.path[-1], path.ep_src, path.ep_dest, len(path.slots)) ==
+                (self.src, self.dest, self.ep_src, self.ep_dest, self.numslots))
 
     def add_path(self, path, pid):
         path_idx = -1
         if self._check_valid_path_parameters(path):
-            if self.paths[0] == None:
-                path_idx = 0
-            elif self.paths[1] == None:
-                path_idx = 1
+            path_idx = self.get_free_path_idx()
             if path_idx >= 0:
                 self.paths[path_idx] = path
                 self.pids[path_idx] = pid
@@ -161,51 +269,37 @@ class TDMinfo():
         self.y_dim = y_dim
         self.num_ep = num_ep
         self.slot_table_size = slot_table_size
+        self._out_ports = get_out_ports(x_dim)
 
         self._initialize_variables()
 
     def _initialize_variables(self):
         # Initialize nodes
-        # Each node holds a list of its EPs and a reference to the channel ID
-        # that uses the EP in in and out direction
-        self.nodes = []
-        for n in range(self.x_dim * self.y_dim):
-            self.nodes.append([])
-            for _ in range(self.num_ep[n]):
-                self.nodes[-1].append([None, None])
+        # For each EP of a node the ID of the channel that uses the EP in out
+        # (index '0') and in (index '1') direction, or -1 if it is free. Only
+        # the first 'num_ep[node]' EPs of a node exist.
+        max_ep = max(self.num_ep[:self.x_dim * self.y_dim], default=0)
+        self.node_ch = np.full((self.x_dim * self.y_dim, max_ep, 2), -1, dtype=np.int32)
 
         # Initialize LUT copy
-        # Each slot contains the configured value and the path ID of the path
-        # the slot is assigned to.
-        self.table_config = []
-        for n in range(self.x_dim * self.y_dim):
-            # Index '0' for router and '1' for NIs
-            self.table_config.append([[], []])
-            # 6 output ports for routers
-            for i in range(6):
-                self.table_config[n][0].append([])
-                for _ in range(self.slot_table_size):
-                    self.table_config[n][0][i].append((EMPTY, None))
-                # Only 4 slot tables for NIs (in and out for each link)
-                if i < 4:
-                    self.table_config[n][1].append([])
-                    for _ in range(self.slot_table_size):
-                        self.table_config[n][1][i].append((EMPTY, None))
+        # For each slot the configured value and the path ID of the path the
+        # slot is assigned to (-1 if none) is stored in two arrays indexed by
+        # [node][router/NI][port][slot]. Index '0' is for the router with 6
+        # output ports, index '1' for the NI which only has 4 slot tables (in
+        # and out for each link).
+        shape = (self.x_dim * self.y_dim, 2, 6, self.slot_table_size)
+        self.table_cfg = np.full(shape, EMPTY, dtype=np.uint8)
+        self.table_pid = np.full(shape, -1, dtype=np.int32)
 
     def reset(self):
-        for n in range(self.x_dim * self.y_dim):
-            for ep in range(self.num_ep[n]):
-                self.nodes[n][ep] = [None, None]
-        for n in range(self.x_dim * self.y_dim):
-            for i in range(6):
-                for s in range(self.slot_table_size):
-                    self.table_config[n][0][i][s] = (EMPTY, None)
-                if i < 4:
-                    for s in range(self.slot_table_size):
-                        self.table_config[n][1][i][s] = (EMPTY, None)
+        self.node_ch.fill(-1)
+        self.table_cfg.fill(EMPTY)
+        self.table_pid.fill(-1)
 
     def set_table_entry(self, node, ni, port, slot, config, pid):
-        self.table_config[node][1 if ni else 0][port][slot] = (config, pid)
+        idx = (node, 1 if ni else 0, port, slot)
+        self.table_cfg[idx] = config
+        self.table_pid[idx] = -1 if pid is None else pid
 
     def get_free_ep(self, node, out=True):
         """
@@ -213,16 +307,14 @@ class TDMinfo():
         first EP that is free, or -1 is none is free.
         """
         epdir = 0 if out else 1
-        for ep in range(len(self.nodes[node])):
-            if self.nodes[node][ep][epdir] is None:
-                return ep
-        return -1
+        free = np.flatnonzero(self.node_ch[node, :self.num_ep[node], epdir] == -1)
+        return int(free[0]) if len(free) > 0 else -1
 
     def assign_ep(self, src, dest, ep_src, ep_dest, chid):
-        if (self.nodes[src][ep_src][0] is None and
-            self.nodes[dest][ep_dest][1] is None):
-            self.nodes[src][ep_src][0] = chid
-            self.nodes[dest][ep_dest][1] = chid
+        if (self.node_ch[src, ep_src, 0] == -1 and
+            self.node_ch[dest, ep_dest, 1] == -1):
+            self.node_ch[src, ep_src, 0] = chid
+            self.node_ch[dest, ep_dest, 1] = chid
             return True
         return False
 
@@ -230,39 +322,56 @@ class TDMinfo():
         """
         Check if a given path is free.
         """
-        hop = 0
-        free = True if self.table_config[path[0]][1][link][start_slot][0] is EMPTY else False
         # Do sanity checks
         if (not check_valid_path(self.x_dim, path) or
             ep_src >= self.num_ep[path[0]] or
             ep_dest >= self.num_ep[path[-1]] or
             link > 1 or
             start_slot >= self.slot_table_size):
-            free = False
-        slot = start_slot
+            return False
         # Check slots in slot tables along the path
-        while hop < len(path) and free:
-            if hop < len(path) - 1:
-                c_node = path[hop]
-                n_node = path[hop+1]
-                out_port = 0 if c_node - self.x_dim == n_node else 1 if c_node + 1 == n_node else 2 if c_node + self.x_dim == n_node else 3
-            else:
-                out_port = link + 4
-            if self.table_config[path[hop]][0][out_port][slot][0] is not EMPTY:
-                free = False
-            slot = (slot + 1) % self.slot_table_size
-            hop += 1
-        if self.table_config[path[-1]][1][link+2][slot][0] is not EMPTY:
-            free = False
-        return free
+        nodes, ni, ports, offsets = get_path_slot_tables(path, link, self._out_ports)
+        slots = (start_slot + offsets) % self.slot_table_size
+        return bool((self.table_cfg[nodes, ni, ports, slots] == EMPTY).all())
+
+    def _free_start_slots(self, path, link, ep_src, ep_dest):
+        """
+        Check for all start slots at once if a given path is free.
+        Returns a boolean array that is 'True' for every free start slot. This
+        is the same as calling 'check_path' for each slot.
+        """
+        if not self._valid_path_parameters(path, link, ep_src, ep_dest):
+            return np.zeros(self.slot_table_size, dtype=bool)
+        return ~_used_start_slots(self.table_cfg, get_path_slot_tables(path, link, self._out_ports))
+
+    def _valid_path_parameters(self, path, link, ep_src, ep_dest):
+        # Sanity checks of a path before its slot tables are accessed
+        return (check_valid_path(self.x_dim, path) and
+                ep_src < self.num_ep[path[0]] and
+                ep_dest < self.num_ep[path[-1]] and
+                link <= 1)
 
     def get_free_slots(self, path, ep_src, ep_dest, link, numslots):
-        start_slots = []
         # Find start slots with a free path
-        for slot in range(self.slot_table_size):
-            slot_available = self.check_path(path, slot, link, ep_src, ep_dest)
-            if slot_available:
-                start_slots.append(slot)
-            if len(start_slots) == numslots:
-                return start_slots
-        return []
+        return _first_slots(self._free_start_slots(path, link, ep_src, ep_dest), numslots)
+
+    def get_free_slots_batched(self, paths, ep_src, ep_dest, numslots):
+        """
+        Find start slots for several paths between the same endpoints. The
+        slot tables of all paths are checked with a single gather. 'paths' is
+        a list of (path, link) tuples. Returns a list with the start
+        slots for each path, which is empty if not enough slots are free.
+        """
+        # Invalid paths have no free slots
+        free_slots = [[] for _ in paths]
+        valid = [i for i, (path, link) in enumerate(paths) if self._valid_path_parameters(path, link, ep_src, ep_dest)]
+        if not valid:
+            return free_slots
+        # Gather the slot tables of all paths at once and reduce them per path
+        tables = [get_path_slot_tables(paths[i][0], paths[i][1], self._out_ports) for i in valid]
+        starts = np.cumsum([0] + [len(t[0]) for t in tables[:-1]])
+        concat = tuple(np.concatenate(arrs) for arrs in zip(*tables))
+        used = np.logical_or.reduceat(_used_slot_entries(self.table_cfg, concat), starts, axis=0)
+        for i, u in zip(valid, used):
+            free_slots[i] = _first_slots(~u, numslots)
+        return free_slots